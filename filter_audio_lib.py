@@ -3,62 +3,47 @@
 # type: ignore
 
 Import("env")  # SCons function - injects 'env' at runtime
-import os
+import re
+
+# Install once per environment even if extra_scripts lists this script twice
+if env.get("AUDIO_FILTER_INSTALLED", False):
+    Return()
+env["AUDIO_FILTER_INSTALLED"] = True
+
+# SD playback/recording sources, matched with a single compiled scan per path
+_SKIP_RE = re.compile(r"(?:play_sd_|record_queue|play_serialflash|record_serialflash)")
+_SKIP_SEARCH = _SKIP_RE.search
+
+# Paths rejected by skip_sd_files; reported once after the build instead of per node
+_SKIPPED = []
+
+def _audio_timestamp_decider(env, node):
+    """Only re-hash Audio library sources when their mtime moves"""
+    # env is the Audio library builder's, so other builders keep the default decider
+    if not env.get("AUDIO_DECIDER_SET", False):
+        env.Decider("MD5-timestamp")
+        env["AUDIO_DECIDER_SET"] = True
+    return node
 
 def skip_sd_files(node):
     """Skip SD card related source files from Audio library"""
-    filepath = str(node.get_path())
-    
-    # Skip SD playback/recording files
-    skip_patterns = [
-        "play_sd_",
-        "record_queue",
-        "play_serialflash",
-        "record_serialflash"
-    ]
+    filepath = node.srcnode().get_path()
     
-    for pattern in skip_patterns:
-        if pattern in filepath:
-            print(f"[FILTER] Skipping: {os.path.basename(filepath)}")
-            return None
+    if _SKIP_SEARCH(filepath):
+        _SKIPPED.append(filepath)
+        return None
     
     return node
 
-# More aggressive filtering - apply to all build nodes
-env.AddBuildMiddleware(skip_sd_files, "*.cpp")
-env.AddBuildMiddleware(skip_sd_files, "*.c")
-env.AddBuildMiddleware(skip_sd_files, "*.cc")
+# Caching #include scans is global and can miss header moves, so it is opt-in
+if env.GetProjectOption("custom_implicit_cache", "no").lower() in ("1", "yes", "true"):
+    env.SetOption("implicit_cache", 1)
 
-# Also filter the source files list before compilation
-def filter_lib_sources(target, source, env):
-    """Remove SD files from library source lists"""
-    try:
-        # Get all library dependencies
-        lib_deps = env.GetProjectOption("lib_deps", [])
-        for lib_builder in env.GetLibBuilders():
-            lib_name = lib_builder.name
-            if "Audio" in lib_name:
-                # Filter source files
-                original_sources = lib_builder.src_files[:]
-                filtered_sources = []
-                
-                for src in original_sources:
-                    src_path = str(src)
-                    skip = any(pattern in src_path for pattern in [
-                        "play_sd_", "record_queue", "play_serialflash", "record_serialflash"
-                    ])
-                    
-                    if skip:
-                        print(f"[LIB_FILTER] Excluding: {os.path.basename(src_path)}")
-                    else:
-                        filtered_sources.append(src)
-                
-                lib_builder.src_files = filtered_sources
-                print(f"[LIB_FILTER] Audio library: {len(original_sources)} -> {len(filtered_sources)} files")
-    except Exception as e:
-        print(f"[LIB_FILTER] Warning: {e}")
+# Runs while the Audio library builder collects its sources, so SD objects are never created
+env.AddBuildMiddleware(skip_sd_files, "*/Audio/*")
+env.AddBuildMiddleware(_audio_timestamp_decider, "*/Audio/*")
 
-# Run the library filter after library scanning
-env.AddPreAction("checkprogsize", filter_lib_sources)
+# One summary line for the middleware instead of a print per skipped node
+env.AddPostAction("buildprog", lambda *args, **kwargs: print(f"[FILTER] skipped {len(_SKIPPED)} SD sources"))
 
 print("[FILTER] Audio library SD file filter installed")
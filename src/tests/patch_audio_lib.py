@@ -1,22 +1,83 @@
 """
 Patch Audio library SD files to compile without SD library
-This script runs after library installation to disable SD-dependent code
+Runs once per Audio install in NO_SD_CARD builds, after which the sources stay
+byte-stable; `pio run -t patch_audio` forces a re-patch
 """
 Import("env")
+import concurrent.futures
 import os
 import shutil
+import tempfile
+
+# Install once per environment even if extra_scripts lists this script twice
+if env.get("AUDIO_PATCH_INSTALLED", False):
+    Return()
+env["AUDIO_PATCH_INSTALLED"] = True
+
+# Resolved once at load instead of on every hook invocation
+_LIBDEPS_DIR = env.subst("$PROJECT_LIBDEPS_DIR")
+_PIOENV = env.subst("$PIOENV")
+_AUDIO_DIR = os.path.join(_LIBDEPS_DIR, _PIOENV, "Audio")
+_NO_SD_BUILD = any("NO_SD_CARD" in str(flag) for flag in env.get("BUILD_FLAGS", []))
+
+# Written once the Audio library has been patched; later builds skip patching
+_SENTINEL = os.path.join(_AUDIO_DIR, ".no_sd_patched")
+
+def _patch_one_file(entry):
+    """Wrap a single Audio SD source in a NO_SD_CARD guard; returns log lines"""
+    filename = entry.name
+    filepath = entry.path
+    messages = []
+    
+    # The guard sits at the top of a patched file, so the head is enough
+    with open(filepath, 'rb') as f:
+        head = f.read(256)
+    
+    if b"#ifndef NO_SD_CARD" in head:
+        return [f"[PATCH] {filename} already patched, skipping"]
+    
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+    
+    # Backup is opt-in; libdeps can always be reinstalled
+    if os.environ.get("PATCH_AUDIO_BACKUP") == "1":
+        backup_path = filepath + ".original"
+        if not os.path.exists(backup_path):
+            shutil.copy2(filepath, backup_path)
+            messages.append(f"[PATCH] Backed up {filename}")
+    
+    # Wrap content with NO_SD_CARD guard
+    patched_content = f"""// Patched by patch_audio_lib.py to support NO_SD_CARD builds
+#ifndef NO_SD_CARD
+
+{content}
+
+#endif // NO_SD_CARD
+"""
+    
+    # Write patched file atomically, leaving no temp file behind on failure
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=f".{filename}.")
+    os.close(fd)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(patched_content)
+        # mkstemp creates 0600; keep the source's mode for other readers of libdeps
+        shutil.copymode(filepath, tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    messages.append(f"[PATCH] ✓ Patched {filename}")
+    return messages
 
 def patch_audio_library(source, target, env):
     """Patch Audio library SD files to be NO_SD_CARD compatible"""
     
-    # Find Audio library directory
-    audio_lib_dir = None
-    for lib_dir in env.get("CPPPATH", []):
-        if "Audio" in lib_dir and "libdeps" in lib_dir:
-            audio_lib_dir = os.path.dirname(lib_dir)
-            break
+    # Audio library is installed under libdeps/<env>/Audio
+    audio_lib_dir = _AUDIO_DIR
     
-    if not audio_lib_dir or not os.path.exists(audio_lib_dir):
+    if not os.path.isdir(audio_lib_dir):
         print("[PATCH] Audio library not found, skipping patch")
         return
     
@@ -29,42 +90,24 @@ def patch_audio_library(source, target, env):
         "record_queue.cpp"
     ]
     
-    for filename in sd_files:
-        filepath = os.path.join(audio_lib_dir, filename)
-        
-        if not os.path.exists(filepath):
-            continue
-        
-        # Check if already patched
-        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        
-        if "#ifndef NO_SD_CARD" in content:
-            print(f"[PATCH] {filename} already patched, skipping")
-            continue
-        
-        # Create backup
-        backup_path = filepath + ".original"
-        if not os.path.exists(backup_path):
-            shutil.copy2(filepath, backup_path)
-            print(f"[PATCH] Backed up {filename}")
-        
-        # Wrap content with NO_SD_CARD guard
-        patched_content = f"""// Patched by patch_audio_lib.py to support NO_SD_CARD builds
-#ifndef NO_SD_CARD
-
-{content}
-
-#endif // NO_SD_CARD
-"""
-        
-        # Write patched file
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(patched_content)
-        
-        print(f"[PATCH] ✓ Patched {filename}")
+    # One directory scan instead of an exists() check per file
+    entries = {e.name: e for e in os.scandir(audio_lib_dir) if e.name.endswith('.cpp')}
+    targets = [entries[name] for name in sd_files if name in entries]
     
+    # Overlap the per-file disk I/O; workers return their log lines so only
+    # this thread prints, and iterating the results surfaces any worker exception
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        for messages in executor.map(_patch_one_file, targets):
+            for message in messages:
+                print(message)
+    
+    open(_SENTINEL, 'wb').close()
     print("[PATCH] Audio library patching complete")
 
-# Run patch after library installation but before compilation
-env.AddPreAction("$BUILD_DIR/${PROGNAME}.elf", patch_audio_library)
+# lib_deps are installed before extra scripts load, so patch now, before any Audio
+# source is compiled; the SD sources only need the guard in NO_SD_CARD builds
+if _NO_SD_BUILD and not os.path.exists(_SENTINEL):
+    patch_audio_library(None, None, env)
+
+# `pio run -t patch_audio` forces a re-patch
+env.AddCustomTarget("patch_audio", None, patch_audio_library)